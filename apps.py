@@ -1,8 +1,13 @@
+import fcntl
+import os
+import re
 import sqlite3
+import time
 
 from django.apps import AppConfig
 from django.conf import settings
 from django.db import connections
+from django.db.backends.signals import connection_created
 
 django_table = """CREATE TABLE IF
 NOT EXISTS "django_content_type" (
@@ -11,17 +16,152 @@ NOT EXISTS "django_content_type" (
  "model" varchar(100) NOT NULL
 );"""
 
+# pages copied per backup step, between progress reports
+backup_step_pages = 10000
+
+# path (ideally on tmpfs) for a read-only snapshot shared by all
+# worker processes on the host, instead of a memory copy per process
+shared_path = getattr(settings, "MEMORY_DB_SHARED", None)
+shared_mmap_size = getattr(settings, "MEMORY_DB_MMAP_SIZE", 2 ** 32)
+
+# limit which tables are copied into memory
+include_tables = getattr(settings, "MEMORY_DB_INCLUDE_TABLES", None)
+exclude_tables = getattr(settings, "MEMORY_DB_EXCLUDE_TABLES", [])
+# attach the source and copy each table in when first queried
+lazy_tables = getattr(settings, "MEMORY_DB_LAZY", False)
+
+
+def copy_database(con, raw):
+    """
+    page level copy of one sqlite connection into another
+    """
+    # an in-memory destination must match the source page size
+    page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    raw.execute("PRAGMA page_size = {0}".format(page_size))
+
+    def progress(status, remaining, total):
+        if total:
+            print("{0}% copied".format(int(100 * (total - remaining) / total)))
+
+    con.backup(raw, pages=backup_step_pages, progress=progress)
+
+
+def read_schema(con):
+    """
+    create statements for the chosen tables in the source,
+    with their indexes and triggers to be run after loading
+    """
+    rows = con.execute("SELECT type, name, tbl_name, sql FROM sqlite_master "
+                       "WHERE sql IS NOT NULL").fetchall()
+    tables = [x[1] for x in rows if x[0] == "table"
+              and x[1].startswith("sqlite_") is False]
+    if include_tables is not None:
+        tables = [x for x in tables if x in include_tables]
+    tables = [x for x in tables if x not in exclude_tables]
+
+    schema = {x: {"create": None, "after": []} for x in tables}
+    for kind, name, table, sql in rows:
+        if table not in schema:
+            continue
+        if kind == "table":
+            schema[table]["create"] = sql
+        elif kind in ["index", "trigger"]:
+            schema[table]["after"].append(sql)
+    return schema
+
+
+def copy_table(cursor, table, schema):
+    """
+    copy a table from the attached source into memory
+    """
+    cursor.execute(schema["create"])
+    cursor.execute('INSERT INTO main."{0}" SELECT * FROM source."{0}"'.format(table))
+
+
+class LazyTables(object):
+    """
+    execute wrapper for a connection with the source attached
+    tables are read from disk until a query first mentions
+    them, then copied into memory (which sqlite searches first)
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.pending = set(schema)
+        self.quoted = re.compile(r'"([^"]+)"')
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.pending:
+            wanted = self.pending.intersection(self.quoted.findall(sql))
+            for table in wanted:
+                self.pending.discard(table)
+                cursor = context["cursor"]
+                copy_table(cursor, table, self.schema[table])
+                for extra in self.schema[table]["after"]:
+                    cursor.execute(extra)
+        return execute(sql, params, many, context)
+
+
+class LazyLoader(object):
+    """
+    attaches the source database to each new connection
+    to the memory database and installs LazyTables
+    """
+
+    def __init__(self, source, alias):
+        self.source = source
+        self.alias = alias
+        con = sqlite3.connect(source)
+        self.schema = read_schema(con)
+        con.close()
+
+    def __call__(self, sender, connection, **kwargs):
+        if connection.alias != self.alias:
+            return
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA foreign_keys = OFF;")
+        cursor.execute("ATTACH DATABASE %s AS source",
+                       ["file:{0}?mode=ro".format(self.source)])
+        # content types are expected, but if the source has them
+        # they are copied in like any other table
+        if "django_content_type" not in self.schema:
+            cursor.execute(django_table)
+        connection.execute_wrappers.append(LazyTables(self.schema))
+
+
+def set_mmap_size(sender, connection, **kwargs):
+    """
+    read the shared snapshot through the page cache
+    """
+    if connection.vendor == "sqlite":
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA mmap_size = {0}".format(shared_mmap_size))
+
 
 class ResearchCommonConfig(AppConfig):
     name = 'research_common'
 
-    def load_to_memory(self, source_name, dest_name):
-       
-        databases = settings.DATABASES
-        print("Copying database to memory for faster performance")
-        con = sqlite3.connect(databases[source_name]["NAME"])
-        dest_con = connections[dest_name]
+    def backup_to_memory(self, con, dest_con):
+        """
+        page level copy of the source into the memory database
+        """
+        dest_con.ensure_connection()
+        raw = dest_con.connection
+        if not isinstance(raw, sqlite3.Connection):
+            raise sqlite3.NotSupportedError("destination is not sqlite")
 
+        copy_database(con, raw)
+
+        # content types are expected, whether or not the source has them
+        cursor = dest_con.cursor()
+        cursor.execute("PRAGMA foreign_keys = OFF;")
+        cursor.execute(django_table)
+        dest_con.commit()
+
+    def dump_to_memory(self, con, dest_con):
+        """
+        replay a sql dump of the source into the memory database
+        """
         # set up the memory table to accept data
         cursor = dest_con.cursor()
         cursor.execute("PRAGMA foreign_keys = OFF;")
@@ -44,17 +184,112 @@ class ResearchCommonConfig(AppConfig):
             cursor.execute(line)
 
         dest_con.commit()
+
+    def select_to_memory(self, source, con, dest_con):
+        """
+        copy only the chosen tables into the memory database
+        indexes are made once all the rows are in
+        """
+        schema = read_schema(con)
+        cursor = dest_con.cursor()
+        cursor.execute("PRAGMA foreign_keys = OFF;")
+        cursor.execute("ATTACH DATABASE %s AS source", [source])
+        for table, table_schema in schema.items():
+            print("Copying {0}".format(table))
+            copy_table(cursor, table, table_schema)
+        for table_schema in schema.values():
+            for extra in table_schema["after"]:
+                cursor.execute(extra)
+        cursor.execute(django_table)
+        dest_con.commit()
+        cursor.execute("DETACH DATABASE source")
+
+    def load_to_memory(self, source_name, dest_name):
+
+        databases = settings.DATABASES
+        print("Copying database to memory for faster performance")
+        start = time.time()
+        source = databases[source_name]["NAME"]
+        con = sqlite3.connect(source)
+        dest_con = connections[dest_name]
+
+        if include_tables is not None or exclude_tables:
+            self.select_to_memory(source, con, dest_con)
+        else:
+            try:
+                self.backup_to_memory(con, dest_con)
+            except sqlite3.Error as e:
+                print("Backup not possible ({0}), loading from dump".format(e))
+                self.dump_to_memory(con, dest_con)
+
         con.close()
 
-        print("Database load complete.")
+        print("Database load complete in {0:.1f}s.".format(time.time() - start))
+
+    def snapshot(self, source, path):
+        """
+        copy the source database to path once per host
+        the first process to get the lock makes it, the rest reuse it
+        """
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path) and \
+                    os.path.getmtime(path) >= os.path.getmtime(source):
+                return
+            print("Snapshotting database to {0}".format(path))
+            start = time.time()
+            tmp = path + ".tmp"
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            con = sqlite3.connect(source)
+            dest = sqlite3.connect(tmp)
+            copy_database(con, dest)
+            dest.execute(django_table)
+            dest.commit()
+            dest.close()
+            con.close()
+            os.replace(tmp, path)
+            print("Snapshot complete in {0:.1f}s.".format(time.time() - start))
+
+    def use_shared(self, source_name, dest_name, path):
+        """
+        point the default database at a read-only, memory
+        mapped snapshot shared between worker processes
+        """
+        self.snapshot(settings.DATABASES[source_name]["NAME"], path)
+        dest_con = connections[dest_name]
+        dest_con.close()
+        # settings_dict is shared with connections made in other threads
+        dest_con.settings_dict["NAME"] = "file:{0}?mode=ro&immutable=1".format(path)
+        dest_con.settings_dict.setdefault("OPTIONS", {})["uri"] = True
+        connection_created.connect(set_mmap_size, weak=False,
+                                   dispatch_uid="research_common_mmap")
+        print("Using shared database at {0}".format(path))
+
+    def use_lazy(self, source_name, dest_name):
+        """
+        leave tables on disk until first queried
+        """
+        loader = LazyLoader(settings.DATABASES[source_name]["NAME"], dest_name)
+        connection_created.connect(loader, weak=False,
+                                   dispatch_uid="research_common_lazy")
+        # connections made before now won't have been set up
+        connections[dest_name].close()
+        print("Tables will be loaded to memory as first used")
 
     def ready(self):
         """
         if a database is configured as memory source, will
         assume the default database is a memory waiting to be uploaded
+        (or, with MEMORY_DB_SHARED set, points it at a shared snapshot)
         """
         source_name = "memory_source"
         dest_name = "default"
 
         if source_name in settings.DATABASES:
-            self.load_to_memory(source_name, dest_name)
+            if shared_path:
+                self.use_shared(source_name, dest_name, shared_path)
+            elif lazy_tables:
+                self.use_lazy(source_name, dest_name)
+            else:
+                self.load_to_memory(source_name, dest_name)
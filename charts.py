@@ -3,37 +3,43 @@ Objects to manage creation of charts and their
 translation into images
 '''
 
-import base64
+import gzip
+import html
 import io
-import json
 import os
 import random
+import re
 import shutil
 import string
-import tempfile
-import time
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
+from itertools import islice
 from urllib.parse import urlencode
 
 import altair as alt
 from altair.utils.schemapi import UndefinedType
 import numpy as np
 import pandas as pd
-from altair_saver import save
 from cryptography.fernet import Fernet
 from django.conf import settings
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import connections
+from django.db.models import (Avg, Case, CharField, Count, F, Max, Min, Q,
+                              Sum, Value, When)
+from django.http import StreamingHttpResponse
 from django.template import Context, Template
 from django.template.loader import get_template, render_to_string
-from django.utils.html import escape
+from django.utils.html import escape, format_html
 from django.utils.safestring import mark_safe
 from django.utils.text import slugify
-from selenium import webdriver
-from selenium.common.exceptions import TimeoutException
-from urllib3.exceptions import MaxRetryError
 
 # load theme
 import research_common.altair_theme as theme
+import research_common.serialization as serialization
+from research_common.render_cache import RenderCache
+from research_common.renderers import get_renderer
+from research_common.spec_store import SpecStore
 
 # register the custom theme under a chosen name
 alt.themes.register('mysoc_theme', lambda: theme.mysoc_theme)
@@ -49,138 +55,499 @@ force_reload = settings.FORCE_EXPORT_CHARTS
 
 media_folder = settings.CHART_FOLDER
 csv_folder = settings.CSV_FOLDER
-chrome_driver_path = settings.CHROME_DRIVER
+csv_export_workers = getattr(settings, "CSV_EXPORT_WORKERS", os.cpu_count() or 1)
+# written alongside each csv, any of "csv.gz" and "parquet"
+csv_export_formats = getattr(settings, "CSV_EXPORT_FORMATS", [])
+# write chart datasets to files loaded by url rather than inline
+external_chart_data = getattr(settings, "EXTERNAL_CHART_DATA", False)
+chart_data_folder = getattr(settings, "CHART_DATA_FOLDER",
+                            os.path.join(media_folder, "data"))
+chart_data_url = getattr(settings, "CHART_DATA_URL",
+                         settings.MEDIA_URL + "charts/data/")
+compact_chart_data = getattr(settings, "COMPACT_CHART_DATA", False)
+# rows of chart data written into each longdesc, None for all
+longdesc_max_rows = getattr(settings, "LONGDESC_MAX_ROWS", None)
+longdesc_cache_size = 512
+longdesc_cache = OrderedDict()
+# wraps urls while writing a longdesc so they can be made into links
+link_marker = "\u2063"
+link_pattern = re.compile("{0}(.*?){0}".format(link_marker))
+# how charts read querysets, see query_methods
+query_method = getattr(settings, "CHART_QUERY_METHOD", "orm")
+# rows rendered at a time by Table.iter_html_table
+html_table_chunk_size = getattr(settings, "HTML_TABLE_CHUNK_SIZE", 1000)
+# most rows a server-side table sends per request
+server_side_max_length = getattr(settings, "SERVER_SIDE_TABLE_MAX_LENGTH", 100)
+# characters of the content hash used to name chart files
+ident_length = getattr(settings, "CHART_IDENT_LENGTH", 10)
 
 
 def group_to_other(df, values_col, years_col, labels_col,
-                   cut_off=2, agg_func="sum", other_label="Other"):
+                   cut_off=2, agg_func="sum", other_label="Other",
+                   share=None, rank_by="overall", rank_func="mean"):
     """
     Group to get lowest values into an 'Other' category
+
+    labels_col and years_col can be lists (multiple label or
+    facet columns). Labels are kept if in the top cut_off (by
+    rank_func of values_col) and, if share is given, make up
+    at least that share of the total. rank_by "year" ranks
+    within each years_col group rather than overall.
+
+    Ties are broken by the order labels first appear, so no
+    more than cut_off labels are ever kept (the old version
+    counted distinct values and could keep more, or leave the
+    frame unchanged).
+
+    The passed dataframe is not changed.
     """
-    pt = df.pivot_table(values_col, labels_col)
-    values = pt[values_col]
-    if len(values.unique()) <= cut_off:
+    labels = [labels_col] if isinstance(labels_col, str) else list(labels_col)
+    years = [years_col] if isinstance(years_col, str) else list(years_col)
+    values = df[values_col]
+
+    # integer code for each label (or combination of labels)
+    if len(labels) == 1:
+        codes, uniques = pd.factorize(df[labels[0]])
+    else:
+        codes = df.groupby(labels, sort=False, observed=True).ngroup().values
+
+    keys = [codes]
+    if rank_by == "year":
+        keys += [df[x].values for x in years]
+    # missing labels (code -1) don't take a place in the ranking
+    # and always go to other
+    labelled = codes != -1
+    ranked = values[labelled]
+    ranked_keys = [x[labelled] for x in keys]
+    score = ranked.groupby(ranked_keys).agg(rank_func)
+    if rank_by == "year":
+        year_levels = list(range(1, len(keys)))
+        ranks = score.groupby(level=year_levels).rank(method="first",
+                                                      ascending=False)
+    else:
+        ranks = score.rank(method="first", ascending=False)
+
+    keep = pd.Series(True, index=score.index)
+    if cut_off is not None:
+        keep &= ranks <= cut_off
+    if share is not None:
+        totals = ranked.groupby(ranked_keys).sum()
+        if rank_by == "year":
+            overall = totals.groupby(level=year_levels).transform("sum")
+        else:
+            overall = totals.sum()
+        keep &= totals / overall >= share
+
+    # back from label (and year) to each row
+    if rank_by == "year":
+        row_index = pd.MultiIndex.from_arrays(keys)
+    else:
+        row_index = codes
+    keep_row = keep.reindex(row_index).fillna(False).values.astype(bool)
+    keep_row &= labelled
+    if keep_row[labelled].all():
         return df
-    top_sectors = values.sort_values(ascending=False)[:cut_off].index
-
-    df["grouped_labels"] = df[labels_col]
-    df.loc[~df[labels_col].isin(
-        top_sectors), "grouped_labels"] = other_label
 
-    gb = df.groupby(["grouped_labels", years_col]).agg(
-        {values_col: agg_func}).reset_index()
-    gb.columns = [labels_col, years_col, values_col]
+    group_keys = []
+    for x in labels:
+        col = df[x]
+        if isinstance(col.dtype, pd.CategoricalDtype) and \
+                other_label not in col.cat.categories:
+            col = col.cat.add_categories([other_label])
+        group_keys.append(col.where(keep_row, other_label))
+    group_keys += [df[x] for x in years]
+
+    gb = values.groupby(group_keys, observed=True).agg(agg_func).reset_index()
+    gb.columns = labels + years + [values_col]
     return gb
 
 
-def query_to_df(query, values: dict):
+def formatted_int_length(value):
+    """
+    length of '{:,d}' for an int, without formatting it
+    """
+    value = int(value)
+    digits = len(str(abs(value)))
+    return digits + (digits - 1) // 3 + (value < 0)
+
+
+def max_label_length(col):
+    """
+    longest label (as an int with thousand separators if
+    it can be one, else as a string) in a column
+    only the min and max are needed for numbers
+    """
+    ints = None
+    if col.dtype.kind in "iub":
+        ints = col
+    elif col.dtype.kind == "f":
+        if np.isfinite(col.values).all():
+            ints = col
+    else:
+        try:
+            ints = col.astype(int)
+        except (ValueError, TypeError):
+            pass
+
+    if ints is not None:
+        if len(ints) == 0:
+            return np.nan
+        return max(formatted_int_length(ints.min()),
+                   formatted_int_length(ints.max()))
+    return col.astype(str).str.len().max()
+
+
+# numpy dtypes for model fields whose values can be read
+# straight into a typed buffer, anything else is left to pandas
+field_dtypes = {
+    "AutoField": np.int64,
+    "BigAutoField": np.int64,
+    "SmallAutoField": np.int64,
+    "IntegerField": np.int64,
+    "BigIntegerField": np.int64,
+    "SmallIntegerField": np.int64,
+    "PositiveIntegerField": np.int64,
+    "PositiveBigIntegerField": np.int64,
+    "PositiveSmallIntegerField": np.int64,
+    "FloatField": np.float64,
+    "BooleanField": np.bool_,
+}
+
+
+def field_dtype(model, lookup):
+    """
+    numpy dtype for a (possibly related) field lookup
+    None where the field isn't one we can type
+    """
+    opts = model._meta
+    field = None
+    for part in lookup.split("__"):
+        if field is not None:
+            if field.is_relation is False or field.related_model is None:
+                # a transform (e.g. date__year) rather than a field
+                return None
+            opts = field.related_model._meta
+        try:
+            field = opts.get_field(part)
+        except FieldDoesNotExist:
+            return None
+    if field.is_relation:
+        if field.many_to_one is False and field.one_to_one is False:
+            return None
+        field = field.target_field
+    return field_dtypes.get(field.get_internal_type(), None)
+
+
+def column_chunk(values, dtype):
+    """
+    one chunk of a column as a series
+    typed directly where possible, else inferred by pandas
+    """
+    if dtype is not None:
+        if None not in values:
+            return pd.Series(np.array(values, dtype=dtype))
+        if dtype is not np.bool_:
+            # numbers with gaps become floats, as pandas would make them,
+            # including chunks that are all null
+            return pd.Series(np.array(values, dtype=np.float64))
+    return pd.Series(list(values))
+
+
+def query_to_df(query, values: dict, chunk_size=2000,
+                category_threshold=None, downcast=False):
     """
     Given a django queryset and a dictionary mapping
     django values to final columns, creates a pandas
     dataframe
+
+    rows are streamed in chunks into typed columns, text
+    columns with fewer distinct values than category_threshold
+    (as a share of rows) become categoricals and downcast
+    shrinks numeric columns to the smallest dtype that fits
     """
     keys = list(values.keys())
     columns = [values[x] for x in values]
+    dtypes = [field_dtype(query.model, x) for x in keys]
+
+    rows = query.values_list(*keys).iterator(chunk_size=chunk_size)
+    chunks = [[] for x in keys]
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        for n, col in enumerate(zip(*chunk)):
+            chunks[n].append(column_chunk(col, dtypes[n]))
 
-    rows = query.values_list(*keys)
-    df = pd.DataFrame(list(rows), columns=columns)
+    return frame_from_chunks(chunks, columns, category_threshold, downcast)
+
+
+def query_to_df_raw(query, values: dict, chunk_size=2000,
+                    category_threshold=None, downcast=False):
+    """
+    As query_to_df, but runs the compiled sql on a database
+    cursor and reads rows with fetchmany, skipping django's
+    per row iterators
+
+    field converters (from_db_value) are not applied, so
+    values (e.g. dates on sqlite) come back as the database
+    returns them
+    """
+    keys = list(values.keys())
+    columns = [values[x] for x in values]
+    dtypes = [field_dtype(query.model, x) for x in keys]
+
+    values_query = query.values_list(*keys)
+    try:
+        sql, params = values_query.query.sql_with_params()
+    except EmptyResultSet:
+        # e.g. query.none(), which never reaches the database
+        return pd.DataFrame([], columns=columns)
+    chunks = [[] for x in keys]
+    with connections[values_query.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            for n, col in enumerate(zip(*chunk)):
+                chunks[n].append(column_chunk(col, dtypes[n]))
+
+    return frame_from_chunks(chunks, columns, category_threshold, downcast)
+
+
+def frame_from_chunks(chunks, columns, category_threshold=None, downcast=False):
+    """
+    join chunks of each column into the final dataframe
+    """
+    if not chunks or not chunks[0]:
+        return pd.DataFrame([], columns=columns)
+
+    data = OrderedDict()
+    for n, col_chunks in enumerate(chunks):
+        col = pd.concat(col_chunks, ignore_index=True)
+        if col.dtype == object and any(x.dtype != object for x in col_chunks):
+            # chunks were typed differently (e.g. dates and a chunk
+            # of nulls), infer over the whole column as pandas would
+            col = pd.Series(col.tolist())
+        if downcast and col.dtype.kind in "iu":
+            col = pd.to_numeric(col, downcast="integer")
+        elif downcast and col.dtype.kind == "f":
+            col = pd.to_numeric(col, downcast="float")
+        elif category_threshold and col.dtype == object:
+            if col.nunique() <= category_threshold * len(col):
+                col = col.astype("category")
+        data[n] = col
+    df = pd.DataFrame(data)
+    df.columns = columns
     return df
 
 
+aggregate_functions = {"sum": Sum,
+                       "mean": Avg,
+                       "count": Count,
+                       "min": Min,
+                       "max": Max}
+
+
+def aggregate_query(query, values: dict, group_by, aggregates,
+                    label=None, top_n=None, other_label="Other"):
+    """
+    Push grouping into the database, so only aggregated
+    rows are read
+
+    group_by is a list of fields and aggregates maps fields to
+    one of aggregate_functions. If label (one of group_by) and
+    top_n are given, labels outside the top_n (ranked by the
+    first aggregate) are grouped as other_label.
+
+    returns the aggregated query and the values mapping to
+    read it with query_to_df
+    """
+    group_fields = list(group_by)
+    if label and top_n:
+        rank_field, rank_func = next(iter(aggregates.items()))
+        ranking = (query.values(label)
+                   .annotate(rank_total=aggregate_functions[rank_func](rank_field))
+                   .order_by("-rank_total")
+                   .values_list(label, flat=True))
+        top = list(ranking[:top_n])
+        query = query.annotate(
+            grouped_label=Case(When(**{label + "__in": top}, then=F(label)),
+                               default=Value(other_label),
+                               output_field=CharField()))
+        group_fields = ["grouped_label" if x == label else x
+                        for x in group_fields]
+
+    new_values = OrderedDict()
+    for field, group_field in zip(group_by, group_fields):
+        new_values[group_field] = values[field]
+    annotations = OrderedDict()
+    for n, (field, func) in enumerate(aggregates.items()):
+        alias = "aggregate_{0}".format(n)
+        annotations[alias] = aggregate_functions[func](field)
+        new_values[alias] = values[field]
+
+    # order_by also clears any model ordering, which would
+    # otherwise be added to the grouping
+    query = (query.values(*group_fields)
+             .annotate(**annotations)
+             .order_by(*group_fields))
+    return query, new_values
+
+
+query_methods = {"orm": query_to_df,
+                 "raw": query_to_df_raw}
+
+
+def hash_df(df, hasher):
+    """
+    feed a dataframe into a hashlib object a column at a time
+    using pandas' vectorised hashing rather than building
+    a string of the whole frame
+    """
+    header = [[str(x) for x in df.columns], [str(x) for x in df.dtypes]]
+    hasher.update(serialization.canonical_dumps(header).encode("utf-8"))
+    hasher.update(pd.util.hash_pandas_object(df.index).values.tobytes())
+    for n in range(len(df.columns)):
+        col = df.iloc[:, n]
+        try:
+            hashed = pd.util.hash_pandas_object(col, index=False)
+        except TypeError:
+            # cells that can't be hashed (lists, dicts)
+            hasher.update(col.to_json().encode('utf-8'))
+        else:
+            hasher.update(hashed.values.tobytes())
+    return hasher
+
+
 def id_generator(size=6, chars=string.ascii_uppercase):
     return ''.join(random.choice(chars) for _ in range(size))
 
 
-class Chrome(object):
-    """
-    stores selenium driver to reduce time spent after
-    first start up
-    """
-    driver = None
-    render_session = False
-    count = 0
-    reset_count = 100
-
-    @classmethod
-    def get_driver(cls):
-        if cls.driver:
-            return cls.driver
-
-        options = webdriver.ChromeOptions()
-        options.add_argument("headless")
-        options.add_argument("--no-sandbox")
-        cls.driver = webdriver.Chrome(executable_path=chrome_driver_path,
-                                      chrome_options=options)
-        return cls.driver
-
-    @classmethod
-    def reset_driver(cls):
-        if cls.driver:
-            cls.driver.quit()
-            cls.driver = None
-        cls.render_session = False
-
-    def __del__(self):
-        if self.driver:
-            self.driver.quit()
-        super(Chrome, self).__del__()
-
-    @classmethod
-    def start_render_session(cls):
-        document = get_template("charts/chart_render.html")
-        html_content = document.render()
-        html_content = html_content.replace("#", "%23")
-        driver = cls.get_driver()
-        driver.get("data:text/html;charset=utf-8," + html_content)
+def int_param(params, key, default):
+    """
+    integer request parameter, the default where it is
+    missing or not a number
+    """
+    try:
+        return int(params.get(key, default))
+    except (TypeError, ValueError):
+        return default
 
-        while True:
-            state = driver.execute_script("return document.readyState")
-            print(state)
-            if state == "complete":
-                break
 
-        print("render page ready")
-        cls.render_session = True
+def replace_data(spec, replacements):
+    """
+    copy of spec with named data references swapped for
+    the replacement (e.g. {"url": ...}) given for that name
+    """
+    if isinstance(spec, list):
+        return [replace_data(x, replacements) for x in spec]
+    if isinstance(spec, dict):
+        name = spec.get("name")
+        if set(spec) == {"name"} and name in replacements:
+            return replacements[name]
+        return {k: replace_data(v, replacements) for k, v in spec.items()}
+    return spec
 
-    @classmethod
-    def _render_altair(cls, chart):
-        if cls.render_session is False:
-            cls.start_render_session()
-        driver = cls.get_driver()
-        loc = chart.image_location
-        folder = os.path.dirname(loc)
-        if os.path.exists(folder) is False:
-            os.makedirs(folder)
-        elem = driver.find_element_by_id("chart_standin")
-        spec = chart.json()
-        command = "drawChart({spec})".format(spec=str(spec))
-        altair_status = driver.execute_script(command)
-        canvas = elem.find_element_by_tag_name("canvas")
-        canvas_base64 = driver.execute_script(
-            "return arguments[0].toDataURL('image/png').substring(21);", canvas)
-        encoded = base64.b64decode(bytes(canvas_base64, 'utf-8'))
-        print(loc)
-        with open(loc, "wb") as fh:
-            fh.write(encoded)
-        return True
-
-    @classmethod
-    def render_altair(cls, chart):
-        result = None
-        # there's a periodic time out error we need to try and catch and avoid
-        while not result:
-            if cls.count >= cls.reset_count:
-                cls.count = 0
-                cls.reset_driver()
-                time.sleep(5)
-            try:
-                result = cls._render_altair(chart)
-                cls.count += 1
-            except (TimeoutException, MaxRetryError):
-                print("Timeout exception, resetting driver and retrying.")
-                cls.count = 0
-                cls.reset_driver()
-                time.sleep(5)
+
+def data_references(spec, found=None):
+    """
+    count references to each named dataset in spec
+    """
+    if found is None:
+        found = Counter()
+    if isinstance(spec, list):
+        for x in spec:
+            data_references(x, found)
+    if isinstance(spec, dict):
+        if set(spec) == {"name"}:
+            found[spec["name"]] += 1
+        for k, v in spec.items():
+            if k != "datasets":
+                data_references(v, found)
+    return found
+
+
+def compact_value(value, places=None):
+    if isinstance(value, float):
+        if places is not None:
+            value = round(value, places)
+        if value.is_integer():
+            value = int(value)
+    return value
+
+
+def compact_datasets(spec, precision, columnar):
+    """
+    shrink the inline datasets of a vega-lite spec
+
+    floats are rounded to the places given in precision (by
+    column) and whole numbers written as ints. If columnar,
+    a dataset used only as the top level data is stored as a
+    single row of column arrays, expanded back into rows by a
+    flatten transform, so column names aren't repeated
+    """
+    datasets = spec.get("datasets")
+    if not datasets:
+        return spec
+
+    references = data_references(spec)
+    top_name = spec.get("data", {}).get("name")
+    spec = dict(spec)
+    new_datasets = {}
+    replacements = {}
+    flattened = None
+    for name, rows in datasets.items():
+        keys = list(OrderedDict.fromkeys(k for row in rows for k in row))
+        columns = OrderedDict((k, [compact_value(row.get(k), precision.get(k))
+                                   for row in rows])
+                              for k in keys)
+        if columnar and rows and name == top_name and references[name] == 1:
+            values = [columns]
+            flattened = keys
+        else:
+            values = [dict(zip(keys, x)) for x in zip(*columns.values())]
+        # rename by the new content, so datasets stay content addressed
+        content = serialization.dumps_bytes(values, sort_keys=True)
+        new_name = "data-" + md5(content).hexdigest()
+        new_datasets[new_name] = values
+        replacements[name] = {"name": new_name}
+
+    spec = replace_data(spec, replacements)
+    spec["datasets"] = new_datasets
+    if flattened:
+        spec["transform"] = [{"flatten": flattened}] + spec.get("transform", [])
+    return spec
+
+
+class ChartDataStore(object):
+    """
+    writes each distinct chart dataset once to a content
+    addressed json file, so it is shipped (and cached by
+    browsers) once however many charts and pages use it
+    """
+
+    def __init__(self, folder=None, url=None):
+        self.folder = folder or chart_data_folder
+        self.url = url or chart_data_url
+        self.urls = {}
+
+    def add(self, name, values):
+        """
+        store dataset (named by altair from a hash of its
+        values) and return the url to load it from
+        """
+        if name in self.urls:
+            return self.urls[name]
+        loc = os.path.join(self.folder, name + ".json")
+        if os.path.exists(loc) is False:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp = "{0}.{1}.tmp".format(loc, os.getpid())
+            with open(tmp, "wb") as fh:
+                fh.write(serialization.dumps_bytes(values))
+            os.replace(tmp, loc)
+        self.urls[name] = self.url + name + ".json"
+        return self.urls[name]
 
 
 class ChartCollection(object):
@@ -193,6 +560,10 @@ class ChartCollection(object):
         self.slug = slug
         self.logo = org_logo
         self.charts = []
+        self.idents = {}
+        self.data_store = None
+        if external_chart_data:
+            self.data_store = ChartDataStore()
         for x in args:
             self.register(x)
 
@@ -216,15 +587,17 @@ class ChartCollection(object):
         """
         for x in self.charts:
             if x.__class__.csv_render:
-                file_exists = os.path.exists(x.csv_location)
+                locations = x.export_locations().values()
+                file_exists = all(os.path.exists(l) for l in locations)
                 if (file_exists is False or force_static):
                     yield x
 
     def _get_driver(self):
         """
-        override to use a different driver
+        renderer from the CHART_RENDERER setting
+        override to use a different one
         """
-        return Chrome.get_driver()
+        return get_renderer()
 
     def export(self, baking_options):
         skip_charts = baking_options.get("skip_assets", False)
@@ -236,8 +609,22 @@ class ChartCollection(object):
             self.export_csvs(force_charts)
 
     def export_csvs(self, force_charts):
-        for c in self.csvs_to_generate(force_charts):
-            c.export_data()
+        charts = list(self.csvs_to_generate(force_charts))
+        if len(charts) == 0:
+            return None
+
+        print("Exporting {0} csvs".format(len(charts)))
+        # frames are gathered here as database connections
+        # (and in-memory databases) don't cross threads
+        frames = [c.export_df() for c in charts]
+        threads = min(csv_export_workers, len(charts))
+        if threads <= 1:
+            for c, df in zip(charts, frames):
+                c.export_data(df)
+            return
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # list forces any exception raised in a worker to surface here
+            list(executor.map(lambda c, df: c.export_data(df), charts, frames))
 
     def export_images(self, force_charts):
         charts = [x for x in self.charts_to_generate(force_charts)
@@ -245,9 +632,27 @@ class ChartCollection(object):
         if len(charts) == 0:
             return None
 
-        print("Exporting {0} images".format(len(charts)))
-        for c in charts:
-            Chrome.render_altair(c)
+        cache = RenderCache.get_cache()
+        if cache:
+            keys = {c: cache.key(c.render_json()) for c in charts}
+        # forcing re-renders everything (e.g. to pick up a new vega
+        # or renderer) and replaces what is cached
+        if cache and not force_charts:
+            charts = [c for c in charts
+                      if cache.fetch(keys[c], c.image_location) is False]
+            print("{0} images from render cache".format(len(keys) - len(charts)))
+
+        if charts:
+            print("Exporting {0} images".format(len(charts)))
+            renderer = self._get_driver()
+            rendered = renderer.render_charts(charts)
+            # placeholder images must not be served to real bakes
+            if cache and renderer.cacheable:
+                for c in rendered:
+                    cache.store(keys[c], c.image_location)
+
+        if cache:
+            cache.save()
 
     def register(self, chart):
         """
@@ -255,7 +660,16 @@ class ChartCollection(object):
         """
 
         if chart._register is None:
-            ident = chart.generate_id()
+            chart.generate_id()
+            # lengthen the ident of a different chart that clashes
+            # so files aren't silently overwritten
+            other = self.idents.get(chart.ident)
+            while other is not None and other.digest != chart.digest:
+                print("Chart ident {0} already used, lengthening".format(
+                    chart.ident))
+                chart.ident = chart.digest[:len(chart.ident) + 1]
+                other = self.idents.get(chart.ident)
+            self.idents.setdefault(chart.ident, chart)
             chart._register = self
             self.charts.append(chart)
 
@@ -297,21 +711,53 @@ class BaseChart(object):
         self.columns = []
         self.rows = []
         self.ident = "unassigned"
+        self.digest = ""
         if file_name:
             self.load_from_file(file_name)
         self.options = {"title": name}
         self.text_options = {}
         self.cell_modifications = []
         self.df = None
+        self.query = None
+        # "orm" or "raw", defaults to the CHART_QUERY_METHOD setting
+        self.query_method = None
+        self.aggregation = None
         self.header = OrderedDict()
 
     def apply_query(self, query):
         """
         create dataframe from django query
         """
-        self.df = query_to_df(query, self.header)
+        self.query = query
+        if self.aggregation:
+            query, values = aggregate_query(query, self.header,
+                                            **self.aggregation)
+            self.df = self.query_to_df(query, values)
+        else:
+            self.df = self.query_to_df(query)
         return self.df
 
+    def query_to_df(self, query, values=None):
+        """
+        dataframe for a query using the chart's query method
+        """
+        if values is None:
+            values = self.header
+        method = self.query_method or query_method
+        return query_methods[method](query, values)
+
+    def set_aggregation(self, group_by, aggregates, label=None,
+                        top_n=None, other_label="Other"):
+        """
+        have apply_query group in the database
+        (see aggregate_query), fields are keys of header
+        """
+        self.aggregation = {"group_by": group_by,
+                            "aggregates": aggregates,
+                            "label": label,
+                            "top_n": top_n,
+                            "other_label": other_label}
+
     @property
     def folders(self):
         a = self.ident[0]
@@ -355,29 +801,35 @@ class BaseChart(object):
         produce a hash as id for this table
         will change with contents
         """
+        hasher = md5()
         if self.df is None:
             columns = [x.as_dict() for x in self.columns]
-            columns = json.dumps(columns)
-            rows = json.dumps(self.rows)
+            columns = serialization.canonical_dumps(columns)
+            rows = serialization.canonical_dumps(self.rows)
             joined = columns + rows
-            joined += json.dumps(self.options)
+            joined += serialization.canonical_dumps(self.options)
+            hasher.update(joined.encode('utf-8'))
         else:
             if hasattr(self, "render_object"):
-                joined = json.dumps(self.render_object().to_dict())
+                hasher.update(self.render_json().encode('utf-8'))
             else:
-                joined = self.df.to_json()
+                self.hash_contents(hasher)
 
-        joined += self.name
-        by_encoded = joined.encode('utf-8')
-        hash = md5(by_encoded).hexdigest()
-        self.ident = ""
-        for h in hash:
+        hasher.update(self.name.encode('utf-8'))
+        self.digest = ""
+        for h in hasher.hexdigest():
             if h in string.digits:
-                self.ident += chr(65 + 8 + int(h))
+                self.digest += chr(65 + 8 + int(h))
             else:
-                self.ident += h
+                self.digest += h
 
-        self.ident = self.ident[:6]
+        self.ident = self.digest[:ident_length]
+
+    def hash_contents(self, hasher):
+        """
+        add the chart's data to the id hash
+        """
+        hash_df(self.df, hasher)
 
     def compile_options(self):
         return self.options
@@ -386,7 +838,7 @@ class BaseChart(object):
         """
         return options to template
         """
-        return mark_safe(json.dumps(self.compile_options()))
+        return mark_safe(serialization.dumps(self.compile_options()))
 
     @property
     def csv_url(self):
@@ -434,13 +886,49 @@ class BaseChart(object):
     def set_text_options(self, **kwargs):
         self.text_options.update(kwargs)
 
-    def export_data(self):
+    def export_df(self):
+        """
+        dataframe written out by export_data
+        """
+        return self.df
 
+    def export_locations(self):
+        """
+        files written by export_data, by format
+        """
         loc = self.csv_location
-        folder = os.path.dirname(loc)
-        if os.path.exists(folder) is False:
-            os.makedirs(folder)
-        self.df.to_csv(loc, index=False)
+        base = loc[:-len(".csv")]
+        locations = OrderedDict([("csv", loc)])
+        for f in csv_export_formats:
+            locations[f] = base + "." + f
+        return locations
+
+    def export_data(self, df=None):
+        """
+        write the data out in each export format
+        each file is written to a temporary name and renamed
+        so an interrupted export never leaves a truncated file
+        """
+        if df is None:
+            df = self.export_df()
+        locations = self.export_locations()
+        folder = os.path.dirname(locations["csv"])
+        os.makedirs(folder, exist_ok=True)
+
+        csv_tmp = "{0}.{1}.tmp".format(locations["csv"], os.getpid())
+        df.to_csv(csv_tmp, index=False)
+        if "csv.gz" in locations:
+            # precompressed copy for nginx's gzip_static
+            tmp = "{0}.{1}.tmp".format(locations["csv.gz"], os.getpid())
+            with open(csv_tmp, "rb") as f_in, gzip.open(tmp, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(tmp, locations["csv.gz"])
+        if "parquet" in locations:
+            tmp = "{0}.{1}.tmp".format(locations["parquet"], os.getpid())
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, locations["parquet"])
+        # csv last, as its presence marks the export as done
+        os.replace(csv_tmp, locations["csv"])
 
 
 class AltairChart(BaseChart):
@@ -475,7 +963,16 @@ class AltairChart(BaseChart):
         self.default_width = default_width
         self.facet_width = facet_width
         self._json = ""
+        self._page_json = ""
+        self._spec = None
+        self._final = None
+        self._spec_state = None
         self.data_source = ""
+        self.longdesc_max_rows = longdesc_max_rows
+        # decimal places to round columns to in the spec's data
+        self.data_precision = {}
+        # whole floats as ints, and column arrays rather than rows
+        self.compact_data = compact_chart_data
 
         self.use_render_site = use_render_site
         if self.use_render_site is None:
@@ -562,8 +1059,17 @@ class AltairChart(BaseChart):
         """
         get url for server image
         """
+        spec = self.render_json()
+        store = SpecStore.get_store()
+        if store:
+            # the server reads the spec from the store by its hash
+            root_url = "{0}/convert_hash".format(settings.VEGALITE_SERVER_URL)
+            parameters = urlencode({"hash": store.save(spec),
+                                    "format": "png",
+                                    "width": 700})
+            return root_url + "?" + parameters
+
         root_url = "{0}/convert_spec".format(settings.VEGALITE_SERVER_URL)
-        spec = self.json()
         encrypt = False
         if settings.VEGALITE_ENCRYPT_KEY:
             key = settings.VEGALITE_ENCRYPT_KEY.encode()
@@ -576,22 +1082,106 @@ class AltairChart(BaseChart):
                                 "width": 700})
         return root_url + "?" + parameters
 
-    def json(self, refresh=False):
+    def df_state(self):
         """
-        render and cache json for charts
+        fingerprint of the frame's contents, so edits made
+        in place are picked up as well as a new frame
         """
+        if self.df is None:
+            return None
+        hasher = md5()
+        hash_df(self.df, hasher)
+        return hasher.hexdigest()
 
-        if self._json and refresh is False:
-            return self._json
-
-        di = self.render_object().to_dict()
+    def spec_state(self):
+        """
+        fingerprint of everything that feeds the compiled spec
+        """
+        return (self.df_state(),
+                repr(self.options),
+                repr(self.text_options),
+                repr(self.title),
+                repr(self.footer),
+                id(self.custom_settings),
+                self.chart_type,
+                self.interactive,
+                self.ratio,
+                self.default_width,
+                self.html_chart_titles,
+                repr(self.data_precision),
+                self.compact_data)
+
+    def compiled_spec(self, refresh=False):
+        """
+        compile the chart to a vega-lite dict once
+        recompiled if anything that feeds it has changed
+        """
+        if self._spec is None or refresh or self.spec_state() != self._spec_state:
+            self._spec = self.render_object().to_dict()
+            self._final = None
+            self._json = ""
+            self._page_json = ""
+            # taken after compiling as render_object fills
+            # in defaults on the options
+            self._spec_state = self.spec_state()
+        return self._spec
+
+    def final_spec(self, refresh=False):
+        """
+        compiled spec with final adjustments
+        """
+        di = self.compiled_spec(refresh)
+        if self._final is not None:
+            return self._final
 
         if di['config']['legend']['title'] == "":
-            di['config']['legend']['title'] = None
+            # copy so the compiled spec is left as it was
+            di = dict(di, config=dict(di['config']))
+            di['config']['legend'] = dict(di['config']['legend'], title=None)
 
-        self._json = json.dumps(di)
+        if self.compact_data or self.data_precision:
+            precision = {k.replace(".", ""): v
+                         for k, v in self.data_precision.items()}
+            di = compact_datasets(di, precision, self.compact_data)
+
+        self._final = di
+        return self._final
+
+    def render_json(self, refresh=False):
+        """
+        render and cache json for charts, with data inline
+        (as used for static rendering, the chart ident and
+        render cache key, so always in the canonical encoding)
+        """
+        di = self.final_spec(refresh)
+        if self._json:
+            return self._json
+
+        self._json = serialization.canonical_dumps(di)
         return self._json
 
+    def json(self, refresh=False):
+        """
+        json for the page, where the collection has a data
+        store datasets are loaded by url rather than inline
+        """
+        inline = self.render_json(refresh)
+        store = None
+        if self._register is not None:
+            store = self._register.data_store
+        if store is None:
+            return inline
+        if self._page_json:
+            return self._page_json
+
+        di = dict(self.final_spec())
+        datasets = di.pop("datasets", {})
+        urls = {name: store.add(name, values)
+                for name, values in datasets.items()}
+        replacements = {k: {"url": v} for k, v in urls.items()}
+        self._page_json = serialization.dumps(replace_data(di, replacements))
+        return self._page_json
+
     def accessible_title(self):
         title = self.title
         if isinstance(title, alt.TitleParams):
@@ -609,8 +1199,16 @@ class AltairChart(BaseChart):
         """
         Make a table that can be put into a longdesc
         that is semi helpful for screen readers
+
+        cached by ident, and capped at longdesc_max_rows rows
         """
-        df = self.fix_df()
+        max_rows = self.longdesc_max_rows
+        key = (self.ident, max_rows)
+        if key in longdesc_cache:
+            longdesc_cache.move_to_end(key)
+            return longdesc_cache[key]
+
+        df = self.df
 
         used_columns = []
 
@@ -631,24 +1229,46 @@ class AltairChart(BaseChart):
         for o in self.options.values():
             used_columns.extend(get_field(o))
 
-        valid_cols = [x for x in df.columns.values if x in used_columns]
-        df = df.loc[:, valid_cols].copy()
+        # only the columns (and rows) used are copied, not the whole frame
+        valid_cols = [x for x in df.columns.values
+                      if x.replace(".", "") in used_columns]
+        df = df.loc[:, valid_cols]
 
-        def clickable_link(url):
-            template = '<a href="{0}">{0}</a>'
-            return mark_safe(template.format(url))
+        total_rows = len(df)
+        if max_rows is not None and total_rows > max_rows:
+            df = df.iloc[:max_rows]
+        df = df.rename(columns={x: x.replace(".", "") for x in valid_cols})
 
         # slightly more readable colours
         if "style" in df.columns:
             df["style"] = df["style"].map(theme.colour_lookup)
             df["style"] = df["style"].str.replace("colour_", "")
             df["style"] = df["style"].str.replace("_", " ")
-        txt = df.to_html(index=False)
 
-        # clickable links if there are urls
+        # clickable links if there are urls, marked as each cell
+        # is written then swapped for links in one pass
+        formatters = {}
         if "url" in df.columns:
-            for x, item in df["url"].iteritems():
-                txt = txt.replace(item, clickable_link(item))
+            formatters["url"] = lambda x: link_marker + str(x) + link_marker
+        txt = df.to_html(index=False, formatters=formatters)
+        if formatters:
+            # to_html doesn't escape quotes, so undo its escaping
+            # and escape the url fully for the attribute
+            txt = link_pattern.sub(
+                lambda m: format_html('<a href="{0}">{0}</a>',
+                                      html.unescape(m.group(1))), txt)
+
+        if len(df) < total_rows:
+            txt += "<p>First {0} of {1} rows shown.".format(len(df), total_rows)
+            if self.__class__.csv_render:
+                txt += ' <a href="{0}">Download all rows as CSV.</a>'.format(
+                    self.csv_url)
+            txt += "</p>"
+
+        if self.ident != "unassigned":
+            longdesc_cache[key] = txt
+            while len(longdesc_cache) > longdesc_cache_size:
+                longdesc_cache.popitem(last=False)
 
         return txt
 
@@ -680,16 +1300,8 @@ class AltairChart(BaseChart):
         else:
             format_str = y_axis.axis.format
         if axis_name and not format_str:
-            col = df[axis_name]
-            try:
-                col = col.astype(int)
-            except ValueError:
-                pass
-            try:
-                col = col.map('{:,d}'.format)
-            except ValueError:
-                pass
-            max_len = col.astype(str).str.len().max()
+            # only runs when the spec is recompiled
+            max_len = max_label_length(df[axis_name])
             if max_len > 5:
                 y_axis.axis.titleX = 0 - (int(max_len * 6.5) + 10)
 
@@ -759,6 +1371,10 @@ class Table(BaseChart):
     code_template = "charts//table_code.html"
     div_template = "charts//div_code_table.html"
     html_table_template = "charts//html_table.html"
+    # parts of html_table_template, used when streaming
+    html_table_head_template = "charts//html_table_head.html"
+    html_table_rows_template = "charts//html_table_rows.html"
+    html_table_foot_template = "charts//html_table_foot.html"
     image_render = False
     csv_render = True
 
@@ -766,12 +1382,40 @@ class Table(BaseChart):
         super().__init__(*args, **kwargs)
         self.format_transformation = {}
         self.format_on_row = {}
+        # take and return a whole column (Series) at once
+        self.format_column = {}
         self.format = self.format_transformation
         self.style = {}
         self.style_on_row = {}
+        self.style_column = {}
+        # only send the header, rows come from server_side_data
+        # (set before apply_query to avoid loading the query)
+        self.server_side = False
+        self.max_length = server_side_max_length
         if self.df is None:
             self.df = pd.DataFrame()
 
+    def apply_query(self, query):
+        """
+        server-side tables keep the query and an empty frame
+        with the right columns, rows are fetched a page at a time
+        """
+        if self.server_side:
+            self.query = query
+            self.df = self.query_to_df(query.none())
+            return self.df
+        return super().apply_query(query)
+
+    def hash_contents(self, hasher):
+        super().hash_contents(hasher)
+        if self.server_side and self.query is not None:
+            hasher.update(str(self.query.query).encode('utf-8'))
+
+    def export_df(self):
+        if self.server_side and self.query is not None:
+            return self.query_to_df(self.query)
+        return self.df
+
     def format_cell(self, column, row, value):
         """
         create a human readable format for the cell
@@ -795,22 +1439,200 @@ class Table(BaseChart):
             if transform:
                 return transform(value)
 
+    def format_values(self, column, series, values, rows):
+        """
+        human readable format for a whole column
+        """
+        transform = self.format_on_row.get(column, None)
+        if transform:
+            return [transform(r) for r in rows]
+        transform = self.format_column.get(column, None)
+        if transform:
+            return list(transform(series))
+        transform = self.format_transformation.get(column, None)
+        if transform:
+            return [transform(v) for v in values]
+        return values
+
+    def style_values(self, column, series, values, rows):
+        """
+        styles for a whole column
+        """
+        transform = self.style_on_row.get(column, None)
+        if transform:
+            return [transform(r) for r in rows]
+        transform = self.style_column.get(column, None)
+        if transform:
+            return list(transform(series))
+        transform = self.style.get(column, None)
+        if transform:
+            return [transform(v) for v in values]
+        return [None] * len(values)
+
+    def table_rows(self, df=None):
+        """
+        formatted value, value and style for each cell
+        worked out a column at a time
+        """
+        if df is None:
+            df = self.df
+
+        # row hooks need the rows iterrows would give them
+        rows = None
+        row_hooks = list(self.format_on_row) + list(self.style_on_row)
+        if any(c in row_hooks for c in df.columns):
+            rows = [r for index, r in df.iterrows()]
+
+        # .values matches the (upcast) values iterrows hands out
+        frame_values = df.values
+        columns = []
+        for n, c in enumerate(df.columns):
+            values = frame_values[:, n]
+            if values.dtype.kind in "mM":
+                values = list(pd.Series(values))
+            else:
+                values = list(values)
+            series = df.iloc[:, n]
+            formatted = self.format_values(c, series, values, rows)
+            styles = self.style_values(c, series, values, rows)
+            columns.append([{"f": f, "v": v, "s": s}
+                            for f, v, s in zip(formatted, values, styles)])
+
+        return [list(r) for r in zip(*columns)]
+
+    def _query_page(self, search, searchable, order, start, length):
+        """
+        filter, order and page the stored query in the database
+        """
+        fields = list(self.header)
+        query = self.query
+        total = query.count()
+        filtered = total
+        if search:
+            condition = Q()
+            for n in searchable:
+                condition |= Q(**{fields[n] + "__icontains": search})
+            query = query.filter(condition)
+            filtered = query.count()
+        if order:
+            query = query.order_by(*[("-" if desc else "") + fields[n]
+                                     for n, desc in order])
+        page = query[start:start + length]
+        return total, filtered, self.query_to_df(page)
+
+    def _df_page(self, search, searchable, order, start, length):
+        """
+        filter, order and page the dataframe
+        """
+        df = self.df
+        total = len(df)
+        if search:
+            mask = np.zeros(len(df), dtype=bool)
+            for n in searchable:
+                col = df.iloc[:, n].astype(str)
+                mask |= col.str.contains(search, case=False, regex=False).values
+            df = df[mask]
+        filtered = len(df)
+        if order:
+            df = df.sort_values([df.columns[n] for n, desc in order],
+                                ascending=[not desc for n, desc in order],
+                                kind="mergesort")
+        page = df.iloc[start:start + length]
+        return total, filtered, page
+
+    def server_side_data(self, params):
+        """
+        answer a datatables server-side request
+        paging, ordering and search go to the query where the
+        table came from apply_query, otherwise the dataframe
+        parameters come from the public so bad values are
+        ignored rather than raising
+        """
+        start = max(0, int_param(params, "start", 0))
+        length = int_param(params, "length", 25)
+        # -1 is datatables' 'all', which a public endpoint can't give
+        if length < 0 or length > self.max_length:
+            length = self.max_length
+        search = params.get("search[value]", "").strip()
+
+        columns = range(len(self.df.columns))
+        searchable = [n for n in columns
+                      if params.get("columns[{0}][searchable]".format(n)) != "false"]
+
+        order = []
+        n = 0
+        while "order[{0}][column]".format(n) in params:
+            column = int_param(params, "order[{0}][column]".format(n), -1)
+            if column in columns:
+                desc = params.get("order[{0}][dir]".format(n)) == "desc"
+                order.append((column, desc))
+            n += 1
+
+        if self.query is not None:
+            get_page = self._query_page
+        else:
+            get_page = self._df_page
+        total, filtered, page = get_page(search, searchable, order,
+                                         start, length)
+
+        data = []
+        styles = []
+        for row in self.table_rows(page):
+            data.append([str(cell["f"]) for cell in row])
+            styles.append([cell["s"] for cell in row])
+
+        return {"draw": int_param(params, "draw", 0),
+                "recordsTotal": total,
+                "recordsFiltered": filtered,
+                "data": data,
+                "styles": styles}
+
     def render_html_table(self):
         """
         makes a boring html table
         """
-        table_rows = []
-        for index, r in self.df.iterrows():
-            row = []
-            for c in self.df.columns:
-                value = r[c]
-                formatted_value = self.format_cell(c, r, value)
-                style = self.style_cell(c, r, value)
-                combo = {"f": formatted_value, "v": value, "s": style}
-                row.append(combo)
-            table_rows.append(row)
-
-        c = {'table': self, 'rows': table_rows}
+        rows = []
+        if self.server_side is False:
+            rows = self.table_rows()
+        c = {'table': self, 'rows': rows}
         template = get_template(self.__class__.html_table_template)
 
         return mark_safe(template.render(c))
+
+    def iter_html_table(self, chunk_size=None):
+        """
+        yield the same markup as render_html_table in row
+        chunks, so memory stays flat however long the table is
+        """
+        if chunk_size is None:
+            chunk_size = html_table_chunk_size
+        cls = self.__class__
+        c = {'table': self}
+        yield get_template(cls.html_table_head_template).render(c)
+        if self.server_side is False:
+            template = get_template(cls.html_table_rows_template)
+            for start in range(0, len(self.df), chunk_size):
+                chunk = self.df.iloc[start:start + chunk_size]
+                c = {'table': self, 'rows': self.table_rows(chunk)}
+                yield template.render(c)
+        yield get_template(cls.html_table_foot_template).render({'table': self})
+
+    def streaming_response(self, chunk_size=None):
+        """
+        serve the table without building it in memory
+        """
+        return StreamingHttpResponse(self.iter_html_table(chunk_size),
+                                     content_type="text/html")
+
+    def write_html_table(self, loc, chunk_size=None):
+        """
+        write the table straight to a (baked) file
+        """
+        folder = os.path.dirname(loc)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp = "{0}.{1}.tmp".format(loc, os.getpid())
+        with open(tmp, "w", encoding="utf-8") as fh:
+            for chunk in self.iter_html_table(chunk_size):
+                fh.write(chunk)
+        os.replace(tmp, loc)
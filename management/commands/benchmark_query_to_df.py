@@ -0,0 +1,42 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from research_common.charts import query_methods
+
+
+class Command(BaseCommand):
+    help = "Time each query_to_df method against a model's rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="app_label.ModelName")
+        parser.add_argument('fields', nargs='+',
+                            help="values to read, e.g. id year fk__name")
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--limit', type=int, default=None)
+
+    def handle(self, *args, **options):
+        model = apps.get_model(options["model"])
+        query = model.objects.all()
+        if options["limit"]:
+            query = query[:options["limit"]]
+        values = {x: x for x in options["fields"]}
+
+        frames = {}
+        for name, method in query_methods.items():
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                frames[name] = method(query, values)
+                timings.append(time.perf_counter() - start)
+            df = frames[name]
+            print("{0}: best {1:.3f}s of {2}, {3} rows, {4:.1f}MB".format(
+                name, min(timings), options["repeat"], len(df),
+                df.memory_usage(deep=True).sum() / 1024 ** 2))
+            print(df.dtypes.to_string())
+
+        first, *others = frames
+        for name in others:
+            same = frames[first].astype(str).equals(frames[name].astype(str))
+            print("{0} matches {1}: {2}".format(name, first, same))
@@ -0,0 +1,34 @@
+import glob
+import json
+import os
+
+from django.core.management.base import BaseCommand
+
+from research_common.serialization import backend, benchmark
+
+
+class Command(BaseCommand):
+    help = "Time the json backends over a folder of saved specs or datasets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('folder', help="folder of .json files")
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        files = sorted(glob.glob(os.path.join(options["folder"], "**", "*.json"),
+                                 recursive=True))
+        objs = []
+        for f in files:
+            with open(f, encoding="utf-8") as fh:
+                objs.append(json.load(fh))
+        print("{0} files, using {1}".format(len(objs), backend))
+
+        results = benchmark(objs, options["repeat"])
+        for name, seconds in results["timings"].items():
+            print("{0}: {1:.3f}s".format(name, seconds))
+        if "orjson" in results["timings"]:
+            different = results["different"]
+            print("{0} of {1} byte-identical".format(
+                len(objs) - len(different), len(objs)))
+            for n in different:
+                print("differs: {0}".format(files[n]))
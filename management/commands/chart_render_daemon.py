@@ -0,0 +1,147 @@
+import base64
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+import research_common.serialization as serialization
+from research_common.renderers import (ChromePool, daemon_address,
+                                       daemon_request, render_daemon,
+                                       render_workers)
+
+
+class RenderStats(object):
+    """
+    queue depth and latency of the requests served
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.waiting = 0
+        self.requests = 0
+        self.rendered = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.last_seconds = 0.0
+
+    def begin(self, count):
+        with self.lock:
+            self.waiting += count
+
+    def end(self, count, failed, seconds):
+        with self.lock:
+            self.waiting -= count
+            self.requests += 1
+            self.rendered += count - failed
+            self.failed += failed
+            self.seconds += seconds
+            self.last_seconds = seconds
+
+    def report(self):
+        with self.lock:
+            return {"uptime": time.time() - self.started,
+                    "waiting": self.waiting,
+                    "requests": self.requests,
+                    "rendered": self.rendered,
+                    "failed": self.failed,
+                    "mean_seconds": self.seconds / self.requests if self.requests else 0,
+                    "last_seconds": self.last_seconds}
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """
+    reads one line of json and replies with one line
+    {"specs": [...]} -> {"images": [base64 png or null], "seconds": ...}
+    {"stats": true} -> counts from RenderStats
+    """
+    pool = None
+    stats = None
+
+    def reply(self, message):
+        self.wfile.write(serialization.dumps_bytes(message) + b"\n")
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+        except ValueError:
+            return self.reply({"error": "Request was not json"})
+
+        if message.get("stats"):
+            return self.reply(self.stats.report())
+
+        specs = message.get("specs", [])
+        start = time.perf_counter()
+        self.stats.begin(len(specs))
+        images = []
+        try:
+            images = self.pool.render_specs(specs)
+        except Exception as e:
+            return self.reply({"error": "Render failed: {0}".format(e)})
+        finally:
+            failed = len(specs) - len([x for x in images if x is not None])
+            self.stats.end(len(specs), failed, time.perf_counter() - start)
+
+        self.reply({"images": [base64.b64encode(x).decode("ascii") if x else None
+                               for x in images],
+                    "seconds": time.perf_counter() - start})
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+class Command(BaseCommand):
+    help = ("Long running chart renderer that keeps warm chrome workers, "
+            "used by bakes when CHART_RENDERER is 'daemon'")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=render_daemon,
+                            help="host:port or path of a unix socket")
+        parser.add_argument('--workers', type=int, default=render_workers)
+        parser.add_argument('--stats', action="store_true",
+                            help="print stats from the running daemon and exit")
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            stats = daemon_request({"stats": True}, 10, options["address"])
+            for k, v in stats.items():
+                print("{0}: {1}".format(k, v))
+            return
+
+        family, address = daemon_address(options["address"])
+        if family == socket.AF_INET:
+            server_class = TCPServer
+        else:
+            server_class = UnixServer
+            # left behind by a daemon that didn't exit cleanly
+            if os.path.exists(address):
+                os.remove(address)
+
+        pool = ChromePool(options["workers"])
+        print("Starting {0} chrome workers".format(pool.size))
+        pool.warm()
+        DaemonHandler.pool = pool
+        DaemonHandler.stats = RenderStats()
+
+        server = server_class(address, DaemonHandler)
+        print("Rendering charts on {0}".format(options["address"]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            pool.quit()
+            if family != socket.AF_INET and os.path.exists(address):
+                os.remove(address)
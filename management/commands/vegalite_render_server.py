@@ -0,0 +1,85 @@
+import os
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.core.management.base import BaseCommand
+
+from research_common.renderers import Chrome
+from research_common.spec_store import SpecStore, valid_key
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """
+    answers /convert_hash?hash=...&format=png from the spec
+    store, keeping each rendered png under its hash
+    """
+    store = None
+    cache_folder = None
+    chrome = None
+
+    def send_png(self, image):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(image)))
+        self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        self.end_headers()
+        self.wfile.write(image)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        spec_hash = params.get("hash", [""])[0]
+        if url.path != "/convert_hash":
+            return self.send_error(404)
+        if params.get("format", ["png"])[0] != "png":
+            return self.send_error(400, "Only png is supported")
+
+        if valid_key.match(spec_hash) is None:
+            return self.send_error(400, "Not a spec hash")
+
+        loc = os.path.join(self.cache_folder, spec_hash + ".png")
+        if os.path.exists(loc):
+            with open(loc, "rb") as fh:
+                return self.send_png(fh.read())
+
+        spec = self.store.load(spec_hash)
+        if spec is None:
+            return self.send_error(404, "Spec not in store")
+
+        image = self.chrome.render_specs([spec])[0]
+        if image is None:
+            return self.send_error(500, "Render failed")
+        tmp = loc + ".tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(image)
+        os.replace(tmp, loc)
+        self.send_png(image)
+
+
+class Command(BaseCommand):
+    help = "Local stand-in for the vega-lite render server, rendering specs from the spec store"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8010)
+        parser.add_argument('--cache', default="render_server_cache",
+                            help="folder for rendered pngs")
+
+    def handle(self, *args, **options):
+        store = SpecStore.get_store()
+        if store is None:
+            print("VEGALITE_SPEC_STORE needs to be set")
+            return
+        os.makedirs(options["cache"], exist_ok=True)
+        RenderHandler.store = store
+        RenderHandler.cache_folder = options["cache"]
+        RenderHandler.chrome = Chrome()
+
+        server = HTTPServer(("127.0.0.1", options["port"]), RenderHandler)
+        print("Rendering on http://127.0.0.1:{0}/convert_hash".format(
+            options["port"]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            RenderHandler.chrome.reset_driver()
@@ -0,0 +1,28 @@
+import os
+from urllib.request import urlopen
+
+from django.core.management.base import BaseCommand
+
+from research_common.renderers import render_assets_folder, vega_assets
+
+
+class Command(BaseCommand):
+    help = "Download the vega scripts used by the headless chart renderer"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help="Download even if the file already exists")
+
+    def handle(self, *args, **options):
+        os.makedirs(render_assets_folder, exist_ok=True)
+        for name, url in vega_assets.items():
+            loc = os.path.join(render_assets_folder, name)
+            if os.path.exists(loc) and not options["force"]:
+                print("{0} already present".format(name))
+                continue
+            print("Downloading {0}".format(url))
+            with urlopen(url) as response:
+                content = response.read()
+            with open(loc, "wb") as fh:
+                fh.write(content)
+        print("Vega assets stored in {0}".format(render_assets_folder))
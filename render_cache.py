@@ -0,0 +1,136 @@
+'''
+Content addressed store of rendered chart images
+so the same spec is only ever rendered once, whatever
+page or slug it turns up under
+'''
+
+import json
+import os
+import shutil
+import threading
+import time
+from hashlib import sha256
+
+from django.conf import settings
+
+cache_folder = getattr(settings, "CHART_RENDER_CACHE", None)
+# bytes kept before least recently used images are evicted
+cache_size = getattr(settings, "CHART_RENDER_CACHE_SIZE", 1024 ** 3)
+
+
+class RenderCache(object):
+    """
+    pngs stored under a hash of the final vega-lite spec
+    the manifest records size and last use of each
+    """
+    manifest_name = "manifest.json"
+    shared = None
+
+    def __init__(self, folder, max_size=None):
+        self.folder = folder
+        self.max_size = max_size
+        self.manifest_location = os.path.join(folder, self.manifest_name)
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.manifest = self.load_manifest()
+
+    @classmethod
+    def get_cache(cls):
+        """
+        cache shared in this process, None if not configured
+        """
+        if cache_folder is None:
+            return None
+        if cls.shared is None:
+            cls.shared = cls(cache_folder, cache_size)
+        return cls.shared
+
+    @staticmethod
+    def key(spec):
+        return sha256(spec.encode("utf-8")).hexdigest()
+
+    def location(self, key):
+        return os.path.join(self.folder, key[:2], key + ".png")
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_location) is False:
+            return {}
+        try:
+            with open(self.manifest_location) as fh:
+                return json.load(fh)
+        except ValueError:
+            print("Render cache manifest unreadable, starting again")
+            return {}
+
+    def fetch(self, key, dest):
+        """
+        put the cached image for key at dest
+        hardlinked where possible, otherwise copied
+        """
+        src = self.location(key)
+        with self.lock:
+            if key not in self.manifest:
+                return False
+            if os.path.exists(src) is False:
+                del self.manifest[key]
+                return False
+            self.manifest[key]["used"] = time.time()
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copyfile(src, dest)
+        return True
+
+    def store(self, key, src):
+        """
+        copy a freshly rendered image into the cache
+        """
+        loc = self.location(key)
+        os.makedirs(os.path.dirname(loc), exist_ok=True)
+        tmp = "{0}.{1}.tmp".format(loc, os.getpid())
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, loc)
+        with self.lock:
+            self.manifest[key] = {"size": os.path.getsize(loc),
+                                  "used": time.time()}
+
+    def evict(self):
+        """
+        drop least recently used images until under the size budget
+        """
+        if not self.max_size:
+            return
+        total = sum(x["size"] for x in self.manifest.values())
+        by_age = sorted(self.manifest.items(), key=lambda x: x[1]["used"])
+        for key, entry in by_age:
+            if total <= self.max_size:
+                break
+            loc = self.location(key)
+            if os.path.exists(loc):
+                os.remove(loc)
+            del self.manifest[key]
+            total -= entry["size"]
+
+    def save(self):
+        """
+        merge with the manifest on disk (another bake may
+        have written to it), evict and write back
+        """
+        with self.lock:
+            on_disk = self.load_manifest()
+            for key, entry in on_disk.items():
+                current = self.manifest.get(key)
+                if current is None:
+                    if os.path.exists(self.location(key)):
+                        self.manifest[key] = entry
+                elif entry["used"] > current["used"]:
+                    current["used"] = entry["used"]
+            self.evict()
+            tmp = "{0}.{1}.tmp".format(self.manifest_location, os.getpid())
+            with open(tmp, "w") as fh:
+                json.dump(self.manifest, fh)
+            os.replace(tmp, self.manifest_location)
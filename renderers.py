@@ -0,0 +1,530 @@
+'''
+Backends that turn altair charts into static images
+
+the renderer is picked with the CHART_RENDERER setting:
+selenium - headless chrome pool (the default)
+native - in-process conversion (vl-convert or altair_saver's node method)
+daemon - sends specs to a running chart_render_daemon, which keeps
+         warm chrome workers between commands
+mock - placeholder pngs, for testing bakes without a browser
+none - skips rendering altogether
+'''
+
+import atexit
+import base64
+import io
+import json
+import os
+import queue
+import re
+import shutil
+import socket
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from altair_saver import save
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.template.loader import get_template
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from urllib3.exceptions import MaxRetryError
+
+import research_common.serialization as serialization
+
+try:
+    import vl_convert
+except ImportError:
+    vl_convert = None
+
+chrome_driver_path = getattr(settings, "CHROME_DRIVER", None)
+renderer_name = getattr(settings, "CHART_RENDERER", "selenium")
+# host:port or the path of a unix socket
+render_daemon = getattr(settings, "CHART_RENDER_DAEMON", "127.0.0.1:8011")
+
+render_workers = getattr(settings, "CHART_RENDER_WORKERS", os.cpu_count() or 1)
+render_batch_size = getattr(settings, "CHART_RENDER_BATCH_SIZE", 20)
+# seconds allowed per chart in a batch
+render_timeout = getattr(settings, "CHART_RENDER_TIMEOUT", 30)
+
+# seconds allowed for the render page to load
+render_page_timeout = getattr(settings, "CHART_RENDER_PAGE_TIMEOUT", 60)
+render_assets_folder = getattr(settings, "CHART_RENDER_ASSETS",
+                               os.path.join(os.path.dirname(__file__),
+                                            "static", "research_common", "vega"))
+
+# versions match those loaded by charts/set_code.html
+vega_assets = OrderedDict([
+    ("vega.js", "https://cdn.jsdelivr.net/npm/vega@5.9.0"),
+    ("vega-lite.js", "https://cdn.jsdelivr.net/npm/vega-lite@4.8.1"),
+    ("vega-embed.js", "https://cdn.jsdelivr.net/npm/vega-embed@6.2.1"),
+])
+
+# vl-convert's vega-lite for each major version in a spec's $schema,
+# 4.17 being the closest it has to the 4.8.1 pages load
+vl_convert_versions = {"4": "4.17"}
+default_vl_convert_version = "4.17"
+schema_major_version = re.compile(r"/vega-lite/v(\d+)")
+
+# resolves once the render page has loaded and its functions exist
+render_ready_script = """
+var done = arguments[arguments.length - 1];
+function check() {
+    done(typeof vegaEmbed !== "undefined" && typeof renderCharts !== "undefined");
+}
+if (document.readyState === "complete") {
+    check();
+} else {
+    window.addEventListener("load", check);
+}
+"""
+
+# hands a list of specs to the render page and waits on the promise
+batch_render_script = """
+var done = arguments[arguments.length - 1];
+renderCharts(arguments[0]).then(done, function (err) {
+    done({"error": String(err)});
+});
+"""
+
+
+_render_page = None
+
+
+def vendored_assets():
+    """
+    paths of the vendored vega assets, None if any are missing
+    """
+    local = [os.path.join(render_assets_folder, x) for x in vega_assets]
+    if all(os.path.exists(x) for x in local):
+        return local
+    return None
+
+
+def render_page_uri():
+    """
+    build the render page once per process as a local file
+    uses the vendored vega assets where they have been downloaded
+    (see the vendor_vega_assets command), otherwise the cdn
+    """
+    global _render_page
+    if _render_page:
+        return _render_page
+
+    local = vendored_assets()
+    if local:
+        scripts = [Path(x).resolve().as_uri() for x in local]
+    else:
+        print("Vendored vega assets not found, render page will use the cdn")
+        scripts = list(vega_assets.values())
+
+    folder = tempfile.mkdtemp(prefix="chart_render_")
+    atexit.register(shutil.rmtree, folder, True)
+    loc = os.path.join(folder, "chart_render.html")
+    document = get_template("charts/chart_render.html")
+    with open(loc, "w", encoding="utf-8") as fh:
+        fh.write(document.render({"scripts": scripts}))
+
+    _render_page = Path(loc).as_uri()
+    return _render_page
+
+
+def write_image(chart, image):
+    """
+    write png bytes to the chart's image location
+    returns True so it can be used in a filter
+    """
+    loc = chart.image_location
+    os.makedirs(os.path.dirname(loc), exist_ok=True)
+    print(loc)
+    # write then rename so cached images hardlinked
+    # into place are never written through
+    tmp = "{0}.{1}.tmp".format(loc, os.getpid())
+    with open(tmp, "wb") as fh:
+        fh.write(image)
+    os.replace(tmp, loc)
+    return True
+
+
+class BaseRenderer(object):
+    """
+    turns a list of charts into images at their image_location
+    subclasses implement render
+    """
+    name = ""
+    # whether images can go in the shared render cache
+    cacheable = True
+
+    def render(self, charts):
+        """
+        render charts, returns the charts that were written
+        """
+        raise NotImplementedError
+
+    def render_charts(self, charts):
+        """
+        render charts and report throughput
+        """
+        start = time.perf_counter()
+        rendered = self.render(charts)
+        taken = time.perf_counter() - start
+        print("Rendered {0} of {1} charts with {2} in {3:.1f}s ({4:.1f} charts/s)".format(
+            len(rendered), len(charts), self.name, taken,
+            len(rendered) / taken if taken else 0))
+        return rendered
+
+    def quit(self):
+        pass
+
+
+class Chrome(object):
+    """
+    a single headless chrome render worker
+    keeps its own driver, render session and reset count
+    so several can run side by side
+    """
+    reset_count = 100
+    # timeouts in a row before giving up on a batch
+    max_retries = 3
+
+    def __init__(self):
+        self.driver = None
+        self.render_session = False
+        self.count = 0
+
+    def get_driver(self):
+        if self.driver:
+            return self.driver
+
+        options = webdriver.ChromeOptions()
+        options.add_argument("headless")
+        options.add_argument("--no-sandbox")
+        self.driver = webdriver.Chrome(executable_path=chrome_driver_path,
+                                       chrome_options=options)
+        return self.driver
+
+    def reset_driver(self):
+        if self.driver:
+            self.driver.quit()
+            self.driver = None
+        self.render_session = False
+
+    def __del__(self):
+        if self.driver:
+            self.driver.quit()
+
+    def start_render_session(self):
+        driver = self.get_driver()
+        driver.get(render_page_uri())
+        driver.set_script_timeout(render_page_timeout)
+        if not driver.execute_async_script(render_ready_script):
+            # retrying won't help, the scripts aren't there to load
+            if vendored_assets() is None:
+                raise ImproperlyConfigured(
+                    "vega assets missing and the cdn couldn't be reached, "
+                    "run manage.py vendor_vega_assets")
+            raise ImproperlyConfigured(
+                "vega assets in {0} didn't load on the render page".format(
+                    render_assets_folder))
+
+        print("render page ready")
+        self.render_session = True
+
+    def render_specs(self, specs):
+        """
+        render a batch of json specs in one webdriver round trip
+        returns png bytes (or None where a spec failed) for each
+        """
+        if self.render_session is False:
+            self.start_render_session()
+        driver = self.get_driver()
+        driver.set_script_timeout(render_timeout * len(specs))
+        images = driver.execute_async_script(batch_render_script, specs)
+        if isinstance(images, dict):
+            raise RuntimeError(images["error"])
+        results = []
+        for i in images:
+            if isinstance(i, dict):
+                print("Render failed: {0}".format(i["error"]))
+                results.append(None)
+            else:
+                # strip 'data:image/png;base64,'
+                results.append(base64.b64decode(i.split(",", 1)[1]))
+        return results
+
+    def render_spec_batch(self, specs):
+        images = None
+        retries = 0
+        # there's a periodic time out error we need to try and catch and avoid
+        while images is None:
+            if self.count >= self.reset_count:
+                self.count = 0
+                self.reset_driver()
+                time.sleep(5)
+            try:
+                images = self.render_specs(specs)
+                self.count += len(specs)
+            except (TimeoutException, MaxRetryError):
+                retries += 1
+                self.count = 0
+                self.reset_driver()
+                if retries > self.max_retries:
+                    raise
+                print("Timeout exception, resetting driver and retrying.")
+                time.sleep(5)
+        return images
+
+    def render_batch(self, charts):
+        """
+        render charts and return those that were written
+        """
+        images = self.render_spec_batch([c.render_json() for c in charts])
+        return [c for c, image in zip(charts, images)
+                if image is not None and write_image(c, image)]
+
+    def render_altair(self, chart):
+        return self.render_batch([chart])
+
+
+class ChromePool(BaseRenderer):
+    """
+    pool of chrome workers that charts are fanned out to
+    drivers are only started when a worker is first used
+    """
+    name = "selenium"
+    shared = None
+
+    def __init__(self, size=None):
+        if size is None:
+            size = render_workers
+        self.size = max(1, int(size))
+        self.chromes = [Chrome() for _ in range(self.size)]
+        self.workers = queue.LifoQueue()
+        for c in self.chromes:
+            self.workers.put(c)
+
+    @classmethod
+    def get_pool(cls):
+        """
+        pool shared by all collections in this process
+        """
+        if cls.shared is None:
+            cls.shared = cls()
+            atexit.register(cls.shared.quit)
+        return cls.shared
+
+    def warm(self):
+        """
+        start every worker's render session ahead of use
+        """
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            list(executor.map(lambda c: c.start_render_session(), self.chromes))
+
+    def render_batch(self, charts):
+        """
+        render a batch of charts on whichever worker is free
+        """
+        worker = self.workers.get()
+        try:
+            return worker.render_batch(charts)
+        finally:
+            self.workers.put(worker)
+
+    def render_spec_batch(self, specs):
+        """
+        render a batch of json specs on whichever worker is free
+        """
+        worker = self.workers.get()
+        try:
+            return worker.render_spec_batch(specs)
+        finally:
+            self.workers.put(worker)
+
+    def render_altair(self, chart):
+        return self.render_batch([chart])
+
+    def map_batches(self, items, func):
+        """
+        split items into batches, run func on each over
+        the workers and join the lists that come back
+        """
+        # keep every worker busy before making batches bigger
+        size = min(render_batch_size, -(-len(items) // self.size))
+        batches = [items[i:i + size]
+                   for i in range(0, len(items), size)]
+        threads = min(self.size, len(batches))
+        if threads <= 1:
+            results = [func(b) for b in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                # list forces any exception raised in a worker to surface here
+                results = list(executor.map(func, batches))
+        return [x for r in results for x in r]
+
+    def render(self, charts):
+        """
+        render all charts, spread over the workers
+        returns the charts that were written
+        """
+        # compile specs up front, this is python bound and
+        # gains nothing from running in the worker threads
+        for c in charts:
+            c.render_json()
+        return self.map_batches(charts, self.render_batch)
+
+    def render_specs(self, specs):
+        """
+        render json specs over the workers
+        returns png bytes (or None where a spec failed) for each
+        """
+        return self.map_batches(specs, self.render_spec_batch)
+
+    def quit(self):
+        for c in self.chromes:
+            c.reset_driver()
+
+
+class NativeRenderer(BaseRenderer):
+    """
+    renders in process without a browser
+    uses vl-convert where installed, otherwise altair_saver
+    (which needs the vega-cli node packages)
+    """
+    name = "native"
+
+    @staticmethod
+    def vl_version(spec):
+        """
+        vl-convert version matching the spec's vega-lite
+        rather than the newer one it defaults to
+        """
+        match = schema_major_version.search(spec.get("$schema", ""))
+        if match is None:
+            return default_vl_convert_version
+        return vl_convert_versions.get(match.group(1), None)
+
+    def render_chart(self, chart):
+        if vl_convert is not None:
+            return vl_convert.vegalite_to_png(
+                chart.render_json(),
+                vl_version=self.vl_version(chart.final_spec()))
+        fh = io.BytesIO()
+        save(chart.final_spec(), fh, fmt="png", method="node")
+        return fh.getvalue()
+
+    def render(self, charts):
+        rendered = []
+        for c in charts:
+            try:
+                image = self.render_chart(c)
+            except Exception as e:
+                print("Render failed: {0}".format(e))
+                continue
+            write_image(c, image)
+            rendered.append(c)
+        return rendered
+
+
+# smallest valid png, a single transparent pixel
+placeholder_png = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+
+class MockRenderer(BaseRenderer):
+    """
+    writes a placeholder png for every chart
+    """
+    name = "mock"
+    cacheable = False
+
+    def render(self, charts):
+        for c in charts:
+            write_image(c, placeholder_png)
+        return list(charts)
+
+
+class NullRenderer(BaseRenderer):
+    """
+    renders nothing, for bakes where images aren't wanted
+    """
+    name = "none"
+    cacheable = False
+
+    def render(self, charts):
+        return []
+
+
+def daemon_address(address=None):
+    """
+    socket family and address for the render daemon
+    """
+    if address is None:
+        address = render_daemon
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def daemon_request(message, timeout=None, address=None):
+    """
+    send one json message to the render daemon and
+    return its reply, each is a single line of json
+    """
+    family, addr = daemon_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(addr)
+        sock.sendall(serialization.dumps_bytes(message) + b"\n")
+        with sock.makefile("rb") as fh:
+            line = fh.readline()
+    if not line:
+        raise ConnectionError("render daemon closed the connection")
+    return json.loads(line)
+
+
+class DaemonRenderer(BaseRenderer):
+    """
+    hands specs to the chart_render_daemon command and writes
+    the pngs it sends back, renders locally if it isn't running
+    """
+    name = "daemon"
+
+    def render(self, charts):
+        specs = [c.render_json() for c in charts]
+        timeout = render_page_timeout + render_timeout * len(specs)
+        try:
+            reply = daemon_request({"specs": specs}, timeout)
+        except OSError as e:
+            print("Render daemon not available ({0}), rendering locally".format(e))
+            return ChromePool.get_pool().render(charts)
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+
+        print("Render daemon took {0:.1f}s".format(reply["seconds"]))
+        return [c for c, image in zip(charts, reply["images"])
+                if image is not None and write_image(c, base64.b64decode(image))]
+
+
+renderers = {
+    ChromePool.name: ChromePool.get_pool,
+    DaemonRenderer.name: DaemonRenderer,
+    NativeRenderer.name: NativeRenderer,
+    MockRenderer.name: MockRenderer,
+    NullRenderer.name: NullRenderer,
+}
+
+
+def get_renderer(name=None):
+    """
+    renderer for the name given or the CHART_RENDERER setting
+    """
+    if name is None:
+        name = renderer_name
+    if name not in renderers:
+        raise ValueError("Unknown chart renderer {0}, options are: {1}".format(
+            name, ", ".join(sorted(renderers))))
+    return renderers[name]()
@@ -0,0 +1,141 @@
+'''
+JSON serialization for chart specs and data
+
+Uses orjson where it is installed and the standard library
+otherwise. Both write compact json without escaping non-ascii
+characters, and the standard library path follows orjson for
+numpy types: float32 at its own precision, datetime64 as a full
+datetime and NaN or infinity as null. Output is the same either
+way, apart from very small or large floats, which the two format
+differently (1e-05 or 1e+16 against 0.00001 or 1e16). benchmark
+checks this for a set of specs.
+
+Anything hashed into chart idents or cache keys goes through
+canonical_dumps, which always uses the standard library, so
+hosts with and without orjson agree on them.
+'''
+
+import datetime
+import json
+import math
+import time
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+backend = "orjson" if orjson else "json"
+
+
+def _default(obj):
+    """
+    types orjson handles natively, for the standard library
+    """
+    if isinstance(obj, np.datetime64):
+        # NaT becomes None
+        return obj.astype("datetime64[us]").item()
+    if isinstance(obj, np.floating) and obj.dtype.itemsize < 8:
+        # shortest repr at the float's own precision
+        return float(str(obj))
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == "M":
+            return obj.astype("datetime64[us]").tolist()
+        if obj.dtype.kind == "f" and obj.dtype.itemsize < 8:
+            return obj.astype(str).astype(float).tolist()
+        return obj.tolist()
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    raise TypeError("{0} is not JSON serializable".format(type(obj)))
+
+
+def _finite(obj):
+    """
+    copy of obj with NaN and infinity replaced by None
+    """
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _finite(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(x) for x in obj]
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return _finite(_default(obj))
+    return obj
+
+
+def _stdlib_dumps(obj, sort_keys=False):
+    try:
+        text = json.dumps(obj, separators=(",", ":"), ensure_ascii=False,
+                          sort_keys=sort_keys, default=_default,
+                          allow_nan=False)
+    except ValueError:
+        # NaN and infinity aren't json, orjson writes them as null
+        text = json.dumps(_finite(obj), separators=(",", ":"),
+                          ensure_ascii=False, sort_keys=sort_keys,
+                          default=_default, allow_nan=False)
+    return text.encode("utf-8")
+
+
+def _orjson_dumps(obj, sort_keys=False):
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    try:
+        return orjson.dumps(obj, option=option)
+    except TypeError:
+        # e.g. ints beyond 64 bits
+        return _stdlib_dumps(obj, sort_keys)
+
+
+def dumps_bytes(obj, sort_keys=False):
+    """
+    obj as utf-8 encoded json
+    """
+    if orjson:
+        return _orjson_dumps(obj, sort_keys)
+    return _stdlib_dumps(obj, sort_keys)
+
+
+def dumps(obj, sort_keys=False):
+    """
+    obj as a json string
+    """
+    return dumps_bytes(obj, sort_keys).decode("utf-8")
+
+
+def canonical_dumps(obj, sort_keys=False):
+    """
+    obj as a json string from the standard library,
+    whichever backend is installed
+    """
+    return _stdlib_dumps(obj, sort_keys).decode("utf-8")
+
+
+def benchmark(objs, repeat=3):
+    """
+    time each backend over objs (e.g. chart specs) and
+    list those where the output isn't byte-identical
+    """
+    backends = {"json": _stdlib_dumps}
+    if orjson:
+        backends["orjson"] = _orjson_dumps
+
+    results = {"timings": {}, "different": []}
+    for name, func in backends.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for o in objs:
+                func(o)
+            timings.append(time.perf_counter() - start)
+        results["timings"][name] = min(timings)
+
+    if orjson:
+        results["different"] = [n for n, o in enumerate(objs)
+                                if _stdlib_dumps(o) != _orjson_dumps(o)]
+    return results
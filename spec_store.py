@@ -0,0 +1,78 @@
+'''
+Content addressed store of compressed vega-lite specs, so
+render server urls only need to carry the spec's hash
+'''
+
+import os
+import re
+import zlib
+from hashlib import sha256
+
+from django.conf import settings
+
+spec_store_folder = getattr(settings, "VEGALITE_SPEC_STORE", None)
+
+valid_key = re.compile(r"^[0-9a-f]{64}$")
+
+
+class SpecStore(object):
+    """
+    zlib compressed specs stored under a hash of the spec
+    """
+    shared = None
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    @classmethod
+    def get_store(cls):
+        """
+        store shared in this process, None if not configured
+        """
+        if spec_store_folder is None:
+            return None
+        if cls.shared is None:
+            cls.shared = cls(spec_store_folder)
+        return cls.shared
+
+    @staticmethod
+    def key(spec):
+        return sha256(spec.encode("utf-8")).hexdigest()
+
+    def location(self, key):
+        if valid_key.match(key) is None:
+            raise ValueError("Not a spec hash: {0}".format(key))
+        return os.path.join(self.folder, key[:2], key + ".json.z")
+
+    def save(self, spec):
+        """
+        store spec (a json string) if new and return its hash
+        """
+        key = self.key(spec)
+        loc = self.location(key)
+        if os.path.exists(loc) is False:
+            os.makedirs(os.path.dirname(loc), exist_ok=True)
+            tmp = "{0}.{1}.tmp".format(loc, os.getpid())
+            with open(tmp, "wb") as fh:
+                fh.write(zlib.compress(spec.encode("utf-8"), 9))
+            os.replace(tmp, loc)
+        return key
+
+    def load_compressed(self, key):
+        """
+        stored bytes for a hash, None if not stored
+        """
+        loc = self.location(key)
+        if os.path.exists(loc) is False:
+            return None
+        with open(loc, "rb") as fh:
+            return fh.read()
+
+    def load(self, key):
+        """
+        spec for a hash, None if not stored
+        """
+        compressed = self.load_compressed(key)
+        if compressed is None:
+            return None
+        return zlib.decompress(compressed).decode("utf-8")
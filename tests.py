@@ -1,3 +1,159 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+from unittest import mock, skipUnless
+
+import numpy as np
+import pandas as pd
+from django.db.backends.signals import connection_created
+from django.db.backends.sqlite3.base import DatabaseWrapper
 from django.test import TestCase
 
-# Create your tests here.
+import research_common.serialization as serialization
+from research_common.apps import LazyLoader
+from research_common.charts import BaseChart, group_to_other
+
+
+def old_group_to_other(df, values_col, years_col, labels_col,
+                       cut_off=2, agg_func="sum", other_label="Other"):
+    """
+    group_to_other as it was before multiple keys and shares
+    """
+    pt = df.pivot_table(values_col, labels_col)
+    values = pt[values_col]
+    if len(values.unique()) <= cut_off:
+        return df
+    top_sectors = values.sort_values(ascending=False)[:cut_off].index
+
+    df["grouped_labels"] = df[labels_col]
+    df.loc[~df[labels_col].isin(
+        top_sectors), "grouped_labels"] = other_label
+
+    gb = df.groupby(["grouped_labels", years_col]).agg(
+        {values_col: agg_func}).reset_index()
+    gb.columns = [labels_col, years_col, values_col]
+    return gb
+
+
+class GroupToOtherTest(TestCase):
+
+    def test_matches_old_function(self):
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            labels = rng.choice(["a", "b", "c", "d", "e", "f", None], 200)
+            df = pd.DataFrame({"label": labels,
+                               "year": rng.integers(2000, 2005, 200),
+                               "value": rng.random(200)})
+            for cut_off in [1, 2, 3, 6]:
+                expected = old_group_to_other(df.copy(), "value", "year",
+                                              "label", cut_off)
+                result = group_to_other(df, "value", "year", "label", cut_off)
+                pd.testing.assert_frame_equal(result.reset_index(drop=True),
+                                              expected.reset_index(drop=True))
+
+    def test_missing_labels_not_ranked(self):
+        df = pd.DataFrame({"label": [None, None, "a", "b", "c"],
+                           "year": [2000] * 5,
+                           "value": [10.0, 9.0, 3.0, 2.0, 1.0]})
+        result = group_to_other(df, "value", "year", "label", cut_off=2)
+        self.assertEqual(sorted(result["label"]), ["Other", "a", "b"])
+        self.assertEqual(result.set_index("label")["value"]["Other"], 20.0)
+
+    def test_ties_broken_by_first_appearance(self):
+        df = pd.DataFrame({"label": ["c", "b", "a", "d"],
+                           "year": [2000] * 4,
+                           "value": [1, 1, 1, 5]})
+        result = group_to_other(df, "value", "year", "label", cut_off=2)
+        self.assertEqual(result.set_index("label")["value"].to_dict(),
+                         {"Other": 2, "c": 1, "d": 5})
+
+        df = pd.DataFrame({"label": ["a", "b", "c"],
+                           "year": [2000] * 3,
+                           "value": [2, 2, 2]})
+        result = group_to_other(df, "value", "year", "label", cut_off=2)
+        self.assertEqual(result.set_index("label")["value"].to_dict(),
+                         {"Other": 2, "a": 2, "b": 2})
+
+    def test_passed_frame_unchanged(self):
+        df = pd.DataFrame({"label": ["a", "b", "c"],
+                           "year": [2000] * 3,
+                           "value": [3.0, 2.0, 1.0]})
+        before = df.copy()
+        group_to_other(df, "value", "year", "label", cut_off=1)
+        pd.testing.assert_frame_equal(df, before)
+
+
+@skipUnless(serialization.orjson, "orjson not installed")
+class SerializationTest(TestCase):
+
+    def test_backends_match(self):
+        objs = [np.float32(0.1),
+                np.array([1.5, np.nan], dtype=np.float32),
+                [float("nan"), float("inf"), np.float64("-inf")],
+                np.datetime64("2020-01-01"),
+                np.datetime64("2020-01-01T01:02:03.5"),
+                np.array(["2020-01-01", "2021-06-01T03:00"], dtype="datetime64[ns]"),
+                {"date": datetime.date(2020, 1, 1),
+                 "time": datetime.datetime(2020, 1, 1, 5),
+                 "int": np.int64(4), "bool": np.bool_(False), "text": "\u00e9"}]
+        for obj in objs:
+            self.assertEqual(serialization._stdlib_dumps(obj),
+                             serialization._orjson_dumps(obj))
+
+    def test_canonical_floats(self):
+        # the backends write these differently, idents must not
+        obj = {"small": 1e-05, "smaller": 1.5e-07, "large": 1e+16}
+        expected = '{"small":1e-05,"smaller":1.5e-07,"large":1e+16}'
+        self.assertEqual(serialization.canonical_dumps(obj), expected)
+
+    def test_ident_independent_of_backend(self):
+        chart = BaseChart(name="floats")
+        chart.rows = [[1e-05, 1.5e-07, 1e+16]]
+        chart.generate_id()
+        digest = chart.digest
+        with mock.patch.object(serialization, "orjson", None):
+            chart.generate_id()
+        self.assertEqual(chart.digest, digest)
+
+
+class LazyLoaderTest(TestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.source = os.path.join(folder, "source.sqlite3")
+        con = sqlite3.connect(self.source)
+        con.execute('CREATE TABLE "django_content_type" ('
+                    '"id" integer NOT NULL PRIMARY KEY AUTOINCREMENT, '
+                    '"app_label" varchar(100) NOT NULL, '
+                    '"model" varchar(100) NOT NULL)')
+        con.execute('INSERT INTO "django_content_type" VALUES (1, "charts", "chart")')
+        con.execute('CREATE TABLE "values" ("id" integer PRIMARY KEY, "value" real)')
+        con.execute('CREATE INDEX "values_value" ON "values" ("value")')
+        con.executemany('INSERT INTO "values" VALUES (?, ?)', [(1, 1.5), (2, 2.5)])
+        con.commit()
+        con.close()
+
+        self.connection = DatabaseWrapper({
+            "ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:",
+            "OPTIONS": {}, "TIME_ZONE": None, "CONN_MAX_AGE": 0,
+            "AUTOCOMMIT": True, "ATOMIC_REQUESTS": False, "CONN_HEALTH_CHECKS": False,
+            "USER": "", "PASSWORD": "", "HOST": "", "PORT": "", "TEST": {}},
+            alias="lazy_test")
+        self.loader = LazyLoader(self.source, "lazy_test")
+        connection_created.connect(self.loader, dispatch_uid="lazy_test")
+
+    def tearDown(self):
+        connection_created.disconnect(dispatch_uid="lazy_test")
+        self.connection.close()
+
+    def test_tables_copied_when_queried(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT "app_label", "model" FROM "django_content_type"')
+            self.assertEqual(cursor.fetchall(), [("charts", "chart")])
+            cursor.execute('SELECT SUM("value") FROM "values"')
+            self.assertEqual(cursor.fetchone()[0], 4.0)
+            cursor.execute("SELECT name FROM main.sqlite_master ORDER BY name")
+            self.assertEqual([x[0] for x in cursor.fetchall()],
+                             ["django_content_type", "sqlite_sequence",
+                              "values", "values_value"])
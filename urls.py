@@ -0,0 +1,7 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path("vega_spec/<str:spec_hash>.json", views.vega_spec, name="vega_spec"),
+]
@@ -1,5 +1,7 @@
+from django.http import Http404, HttpResponse, JsonResponse
 from django_sourdough.views import postlogic, prelogic
-from .charts import ChartCollection, BaseChart
+from .charts import ChartCollection, BaseChart, Table
+from .spec_store import SpecStore
 
 
 class AnchorChartsMixIn(object):
@@ -43,3 +45,45 @@ class AnchorChartsMixIn(object):
         else:
             self.chart_collection = None
     anchor_charts.order = 99
+
+
+class ServerSideTableMixIn(object):
+    """
+    Answers datatables server-side requests for tables
+    with server_side set, instead of rendering the page
+
+    use with AnchorChartsMixIn, ahead of the view class
+    """
+    table_data_parameter = "table_data"
+
+    def render_to_response(self, context, **kwargs):
+        ident = self.request.GET.get(self.table_data_parameter)
+        if ident is None:
+            return super().render_to_response(context, **kwargs)
+
+        charts = []
+        if self.chart_collection:
+            charts = self.chart_collection.charts
+        for chart in charts:
+            if isinstance(chart, Table) and chart.ident == ident:
+                return JsonResponse(chart.server_side_data(self.request.GET))
+        raise Http404("No table matches {0}".format(ident))
+
+
+def vega_spec(request, spec_hash):
+    """
+    serve a stored spec to the render server by its hash
+    sent still compressed, as zlib is http's deflate encoding
+    """
+    store = SpecStore.get_store()
+    if store is None:
+        raise Http404("No spec store configured")
+    try:
+        compressed = store.load_compressed(spec_hash)
+    except ValueError:
+        compressed = None
+    if compressed is None:
+        raise Http404("No spec stored for {0}".format(spec_hash))
+    response = HttpResponse(compressed, content_type="application/json")
+    response["Content-Encoding"] = "deflate"
+    return response